@@ -1,96 +1,256 @@
 import redis.asyncio as redis
-import json
+from fastapi import BackgroundTasks, Request, Response
+import hashlib
+import orjson
 import pickle
+import msgpack
+import lz4.frame
+import xxhash
 from typing import Optional, Any, Union
 from functools import wraps
+from cachetools import TTLCache
 import asyncio
+import logging
 import os
+import socket
 from dotenv import load_dotenv
 from datetime import timedelta
 
 load_dotenv()
 
+log = logging.getLogger("cache")
+
+# Префикс формата: "m" = msgpack, "b" = сырые bytes, "s" = str,
+# "z" = lz4-сжатый тегированный payload, всё остальное — старый pickle
+MSGPACK_PREFIX = b"m"
+BYTES_PREFIX = b"b"
+STR_PREFIX = b"s"
+LZ4_PREFIX = b"z"
+
+# Порог сжатия: мелкие значения сжимать невыгодно, крупные режут трафик до Redis в разы
+COMPRESS_MIN_SIZE = 4096
+
+def _msgpack_default(obj):
+    """Приводим несериализуемые объекты (pydantic-модели, UUID, naive datetime) к простым типам"""
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump()
+    return str(obj)
+
+def _serialize(value: Any) -> bytes:
+    """Сериализуем значение с тегом формата; bytes/str кладём как есть — без msgpack"""
+    if isinstance(value, (bytes, bytearray)):
+        payload = BYTES_PREFIX + bytes(value)
+    elif isinstance(value, str):
+        payload = STR_PREFIX + value.encode()
+    else:
+        payload = MSGPACK_PREFIX + msgpack.packb(
+            value, use_bin_type=True, datetime=True, default=_msgpack_default
+        )
+    if len(payload) > COMPRESS_MIN_SIZE:
+        payload = LZ4_PREFIX + lz4.frame.compress(payload)
+    return payload
+
+def _deserialize(data: bytes) -> Any:
+    """Обратная операция к _serialize с fallback на старый pickle-формат"""
+    tag = data[:1]
+    if tag == LZ4_PREFIX:
+        data = lz4.frame.decompress(data[1:])
+        tag = data[:1]
+    if tag == MSGPACK_PREFIX:
+        return msgpack.unpackb(data[1:], raw=False, timestamp=3)
+    if tag == BYTES_PREFIX:
+        return bytes(data[1:])
+    if tag == STR_PREFIX:
+        return data[1:].decode()
+    # Старые записи, сохранённые до перехода на msgpack
+    return pickle.loads(data)
+
+# L1-кэш процесса перед Redis: lookup по dict вместо TCP round-trip для горячих ключей.
+# TTL заметно меньше Redis TTL, чтобы рассинхрон между воркерами был ограничен
+_local = TTLCache(maxsize=10_000, ttl=30)
+
+# Pub/sub-канал, по которому воркеры сообщают друг другу об инвалидациях L1
+INVALIDATION_CHANNEL = "cache:invalidate"
+
+def task_cache_key(task_id: int) -> str:
+    """Единый детерминированный ключ кэша задачи — и для чтения, и для инвалидации"""
+    return f"task:get_task_by_id:{task_id}"
+
 class RedisCache:
     def __init__(self):
         self.client: Optional[redis.Redis] = None
         self.ttl = int(os.getenv("REDIS_TTL", 300))  # 5 минут по умолчанию
         self.enabled = os.getenv("CACHE_ENABLED", "true").lower() == "true"
+        # Снимок статистики, обновляемый фоновой задачей (INFO — дорогая команда)
+        self._stats_cache: dict = {}
+        self._stats_task: Optional[asyncio.Task] = None
+        # Слушатель pub/sub-инвалидаций L1-кэша от других воркеров
+        self._invalidation_task: Optional[asyncio.Task] = None
         
     async def connect(self):
         """Подключаемся к Redis"""
         if not self.enabled:
-            print("Cache is disabled")
+            log.info("Cache is disabled")
             return
             
         try:
             redis_url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
             self.client = redis.from_url(
                 redis_url,
-                encoding="utf-8",
-                decode_responses=False  # Мы сами будем декодировать
+                decode_responses=False,  # Мы сами будем декодировать
+                # Ограничиваем пул и держим TCP-сокеты живыми между всплесками,
+                # чтобы не платить за хендшейк на каждый burst
+                max_connections=64,
+                socket_keepalive=True,
+                socket_keepalive_options={socket.TCP_KEEPIDLE: 60},
+                health_check_interval=30
             )
             await self.client.ping()
-            print("Redis cache connected")
+            # Статистику собираем в фоне, а не на каждый запрос /cache/stats
+            self._stats_task = asyncio.create_task(self._refresh_stats_loop(interval=5))
+            # Подписываемся на инвалидации L1 от других воркеров
+            self._invalidation_task = asyncio.create_task(self._listen_invalidations())
+            log.info("Redis cache connected")
         except Exception as e:
-            print(f"Failed to connect to Redis: {e}")
+            log.error("Failed to connect to Redis: %s", e)
             self.client = None
-            
+
     async def disconnect(self):
         """Отключаемся от Redis"""
+        if self._stats_task:
+            self._stats_task.cancel()
+            self._stats_task = None
+        if self._invalidation_task:
+            self._invalidation_task.cancel()
+            self._invalidation_task = None
+        _local.clear()
         if self.client:
             await self.client.close()
             self.client = None
+
+    async def _listen_invalidations(self):
+        """Сбрасываем локальные L1-записи по сообщениям других воркеров"""
+        pubsub = self.client.pubsub()
+        await pubsub.subscribe(INVALIDATION_CHANNEL)
+        try:
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                data = message["data"]
+                if data.startswith(b"key:"):
+                    _local.pop(data[4:].decode(), None)
+                else:
+                    # Инвалидация тега: принадлежность ключей тегу локально не отслеживается,
+                    # поэтому чистим весь L1 — он мал и переживет это без последствий
+                    _local.clear()
+        finally:
+            await pubsub.close()
             
     def is_connected(self) -> bool:
         """Проверяем подключение к Redis"""
         return self.client is not None and self.enabled
         
-    async def set(self, key: str, value: Any, ttl: Optional[int] = None) -> bool:
-        """Сохраняем значение в кэш"""
+    async def set(self, key: str, value: Any, ttl: Optional[int] = None,
+                  tag: Optional[str] = None) -> bool:
+        """Сохраняем значение в кэш; с tag ключ регистрируется в Set-индексе idx:{tag}"""
         if not self.is_connected():
             return False
-            
+
         try:
-            # Сериализуем значение
-            serialized = pickle.dumps(value)
-            
+            # Сериализуем значение (msgpack компактнее и быстрее pickle для JSON-подобных данных)
+            serialized = _serialize(value)
+
             # Устанавливаем TTL
             expire_time = ttl if ttl is not None else self.ttl
-            
+
+            _local[key] = value
+
+            if tag:
+                pipe = self.client.pipeline(transaction=False)
+                pipe.setex(key, timedelta(seconds=expire_time), serialized)
+                pipe.sadd(f"idx:{tag}", key)
+                results = await pipe.execute()
+                return results[0] is True
+
             result = await self.client.setex(
-                key, 
-                timedelta(seconds=expire_time), 
+                key,
+                timedelta(seconds=expire_time),
                 serialized
             )
             return result is True
         except Exception as e:
-            print(f"Cache set error: {e}")
+            log.exception("Cache set error")
             return False
             
+    def set_background(self, key: str, value: Any, ttl: Optional[int] = None,
+                       tag: Optional[str] = None):
+        """Запускаем set() в фоне — ответ клиенту не ждет записи в Redis"""
+        if self.is_connected():
+            _schedule_cache_write(self.set(key, value, ttl, tag=tag))
+
     async def get(self, key: str) -> Optional[Any]:
-        """Получаем значение из кэша"""
+        """Получаем значение из кэша (сначала L1 процесса, затем Redis)"""
         if not self.is_connected():
             return None
-            
+
+        local_value = _local.get(key)
+        if local_value is not None:
+            return local_value
+
         try:
             data = await self.client.get(key)
             if data:
-                return pickle.loads(data)
+                value = _deserialize(data)
+                _local[key] = value
+                return value
             return None
         except Exception as e:
-            print(f"Cache get error: {e}")
+            log.exception("Cache get error")
             return None
             
+    async def mget(self, keys: list) -> list:
+        """Получаем несколько значений одним запросом (один RTT вместо N)"""
+        if not self.is_connected() or not keys:
+            return [None] * len(keys)
+
+        try:
+            raw = await self.client.mget(keys)
+            return [_deserialize(data) if data is not None else None for data in raw]
+        except Exception as e:
+            log.exception("Cache mget error")
+            return [None] * len(keys)
+
+    async def mset(self, mapping: dict, ttl: Optional[int] = None) -> bool:
+        """Сохраняем несколько значений одним pipeline (SETEX не теряет TTL, как MSET)"""
+        if not self.is_connected() or not mapping:
+            return False
+
+        try:
+            expire_time = ttl if ttl is not None else self.ttl
+            pipe = self.client.pipeline(transaction=False)
+            for key, value in mapping.items():
+                pipe.setex(key, expire_time, _serialize(value))
+            await pipe.execute()
+            return True
+        except Exception as e:
+            log.exception("Cache mset error")
+            return False
+
     async def delete(self, key: str) -> bool:
         """Удаляем значение из кэша"""
         if not self.is_connected():
             return False
             
         try:
-            result = await self.client.delete(key)
+            _local.pop(key, None)
+            pipe = self.client.pipeline(transaction=False)
+            pipe.delete(key)
+            # Сообщаем другим воркерам, чтобы они сбросили свой L1
+            pipe.publish(INVALIDATION_CHANNEL, f"key:{key}")
+            result, _ = await pipe.execute()
             return result > 0
         except Exception as e:
-            print(f"Cache delete error: {e}")
+            log.exception("Cache delete error")
             return False
             
     async def delete_pattern(self, pattern: str) -> int:
@@ -99,30 +259,76 @@ class RedisCache:
             return 0
             
         try:
-            keys = await self.client.keys(pattern)
-            if keys:
-                return await self.client.delete(*keys)
-            return 0
+            # SCAN вместо KEYS: не блокируем однопоточный Redis на больших базах,
+            # а DEL отправляем пачками через pipeline, чтобы не платить RTT за каждый ключ
+            pipe = self.client.pipeline(transaction=False)
+            count = 0
+            async for key in self.client.scan_iter(match=pattern, count=1000):
+                pipe.delete(key)
+                count += 1
+                if count % 500 == 0:
+                    await pipe.execute()
+            await pipe.execute()
+            return count
         except Exception as e:
-            print(f"Cache delete pattern error: {e}")
+            log.exception("Cache delete pattern error")
             return 0
             
+    async def invalidate_tag(self, tag: str, extra_keys=()) -> int:
+        """Удаляем все ключи тега и extra_keys одним pipeline: O(размера индекса), без SCAN"""
+        if not self.is_connected():
+            return 0
+
+        try:
+            _local.clear()
+            idx_key = f"idx:{tag}"
+            keys = await self.client.smembers(idx_key)
+            pipe = self.client.pipeline(transaction=False)
+            for key in keys:
+                pipe.delete(key)
+            # Точечные ключи мутации (например, кэш конкретной задачи) едут тем же pipeline
+            for key in extra_keys:
+                pipe.delete(key)
+                pipe.publish(INVALIDATION_CHANNEL, f"key:{key}")
+            pipe.delete(idx_key)
+            pipe.publish(INVALIDATION_CHANNEL, f"tag:{tag}")
+            await pipe.execute()
+            return len(keys) + len(extra_keys)
+        except Exception as e:
+            log.exception("Cache invalidate tag error")
+            return 0
+
     async def clear_all(self) -> bool:
         """Очищаем весь кэш"""
         if not self.is_connected():
             return False
             
         try:
-            return await self.client.flushdb()
+            _local.clear()
+            result = await self.client.flushdb()
+            await self.client.publish(INVALIDATION_CHANNEL, "tag:*")
+            return result
         except Exception as e:
-            print(f"Cache clear error: {e}")
+            log.exception("Cache clear error")
             return False
             
     async def get_stats(self) -> dict:
-        """Получаем статистику кэша"""
+        """Получаем статистику кэша (снимок фонового сборщика)"""
         if not self.is_connected():
             return {"enabled": False}
-            
+
+        if not self._stats_cache:
+            # Первый вызов до того, как фоновая задача успела отработать
+            self._stats_cache = await self._collect_stats()
+        return self._stats_cache
+
+    async def _refresh_stats_loop(self, interval: int = 5):
+        """Периодически обновляем снимок статистики, чтобы INFO/DBSIZE не ходили на request path"""
+        while True:
+            self._stats_cache = await self._collect_stats()
+            await asyncio.sleep(interval)
+
+    async def _collect_stats(self) -> dict:
         try:
             info = await self.client.info()
             return {
@@ -136,59 +342,186 @@ class RedisCache:
                           max(1, info.get("keyspace_hits", 0) + info.get("keyspace_misses", 0))
             }
         except Exception as e:
-            print(f"Cache stats error: {e}")
+            log.exception("Cache stats error")
             return {"enabled": True, "connected": False, "error": str(e)}
 
+# Ключи, по которым прямо сейчас выполняется функция (single-flight):
+# параллельные промахи одного ключа ждут общий Future вместо повторного вычисления
+_inflight: dict = {}
+
+def _cached_response(body: bytes, ttl: Optional[int], request: Optional[Request]) -> Response:
+    """Ответ из кэшированных байтов с HTTP-кэшированием поверх Redis:
+    сильный ETag (xxhash от тела) + Cache-Control, при совпадении
+    If-None-Match отдаем пустой 304 вместо полного тела"""
+    etag = f'"{xxhash.xxh64(body).hexdigest()}"'
+    headers = {"X-Cache": "HIT", "ETag": etag}
+    if ttl:
+        headers["Cache-Control"] = f"public, max-age={ttl}"
+    if request is not None and request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+async def _wait_for_fill(cache, cache_key: str, attempts: int = 10, delay: float = 0.05):
+    """Другой процесс держит замок пересчета — коротко ждем появления значения в кэше.
+
+    Возвращает сырые кэшированные байты (или объект старого формата):
+    Response с ETag/304 собирает вызывающий под свой If-None-Match.
+    """
+    for _ in range(attempts):
+        await asyncio.sleep(delay)
+        refreshed = await cache.get(cache_key)
+        if refreshed is not None:
+            return refreshed
+    return None
+
+async def _store_and_unlock(cache, cache_key: str, body: bytes,
+                            ttl: Optional[int], tag: str, locked: bool):
+    """Фоновая запись результата с освобождением межпроцессного замка"""
+    await cache.set(cache_key, body, ttl, tag=tag)
+    if locked:
+        try:
+            await cache.client.delete(f"lock:{cache_key}")
+        except Exception:
+            log.exception("Cache unlock error")
+
+# Держим ссылки на фоновые записи в кэш, чтобы задачи не собрал GC до завершения
+_background_writes: set = set()
+
+def _schedule_cache_write(coro):
+    """Записываем в кэш в фоне: клиенту не важно, успела ли запись"""
+    task = asyncio.create_task(coro)
+    _background_writes.add(task)
+    task.add_done_callback(_on_cache_write_done)
+
+def _on_cache_write_done(task: asyncio.Task):
+    _background_writes.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        log.error("Background cache write failed: %s", task.exception())
+
 # Декоратор для кэширования
 def cache_response(ttl: Optional[int] = None, key_prefix: str = "cache"):
     """Декоратор для кэширования ответов API"""
     def decorator(func):
         @wraps(func)
         async def wrapper(*args, **kwargs):
-            # Создаем ключ кэша на основе функции и аргументов
+            # Создаем ключ кэша на основе функции и аргументов.
+            # Встроенный hash() рандомизирован per-process (PYTHONHASHSEED),
+            # поэтому берём детерминированный BLAKE2b — ключи совпадают между воркерами
             cache_key = f"{key_prefix}:{func.__name__}"
-            
-            # Добавляем аргументы в ключ
-            if args:
-                cache_key += f":{hash(str(args))}"
-            if kwargs:
-                cache_key += f":{hash(str(sorted(kwargs.items())))}"
+
+            # Служебные DI-объекты FastAPI (BackgroundTasks, Request) уникальны
+            # для каждого запроса — в ключ идут только данные
+            key_kwargs = sorted(
+                (k, v) for k, v in kwargs.items()
+                if not isinstance(v, (BackgroundTasks, Request))
+            )
+            if args or key_kwargs:
+                payload = msgpack.packb(
+                    (args, key_kwargs), use_bin_type=True, default=repr
+                )
+                digest = hashlib.blake2b(payload, digest_size=16).hexdigest()
+                cache_key += f":{digest}"
                 
+            # Request нужен только для If-None-Match — в ключ кэша он не входит
+            request = next(
+                (v for v in kwargs.values() if isinstance(v, Request)), None
+            )
+
             # Пытаемся получить из кэша
             cache = redis_cache
             if cache.is_connected():
                 cached_result = await cache.get(cache_key)
                 if cached_result is not None:
-                    print(f"Cache hit: {cache_key}")
+                    log.debug("cache hit %s", cache_key)
+                    if isinstance(cached_result, (bytes, bytearray)):
+                        # Готовый JSON отдаем как есть — без повторной сериализации,
+                        # а при совпадении ETag клиента — вообще без тела (304)
+                        return _cached_response(bytes(cached_result), ttl, request)
+                    # Записи старого формата (до перехода на кэширование байтов)
                     return cached_result
-                print(f"Cache miss: {cache_key}")
-                    
+                log.debug("cache miss %s", cache_key)
+
+            # Single-flight: если этот же ключ уже вычисляется — ждем его результат,
+            # не дублируя запрос к БД (thundering herd при истечении TTL горячего ключа).
+            # Future несет сырые байты/объект, а не Response: 304 по If-None-Match
+            # легален только для условного запроса, поэтому Response — свой на каждого
+            fut = _inflight.get(cache_key)
+            if fut is not None:
+                result = await fut
+                if isinstance(result, (bytes, bytearray)):
+                    return _cached_response(bytes(result), ttl, request)
+                return result
+
+            fut = asyncio.get_running_loop().create_future()
+            _inflight[cache_key] = fut
+
             # Выполняем функцию
-            result = await func(*args, **kwargs)
-            
-            # Сохраняем в кэш
-            if cache.is_connected() and result is not None:
-                await cache.set(cache_key, result, ttl)
-                
+            computed = False
+            got_lock = False
+            try:
+                result = None
+                if cache.is_connected():
+                    try:
+                        # Межпроцессный замок: на весь деплой ключ пересчитывает один воркер,
+                        # остальные дожидаются значения в Redis
+                        got_lock = await cache.client.set(
+                            f"lock:{cache_key}", b"1", nx=True, ex=5
+                        )
+                    except Exception:
+                        # Redis отвалился после connect() — фейлимся открыто,
+                        # как остальные методы RedisCache, и считаем локально
+                        log.exception("Cache lock error")
+                    else:
+                        if not got_lock:
+                            result = await _wait_for_fill(cache, cache_key)
+
+                if result is None:
+                    # Замок наш, либо ожидание не дало результата — считаем сами
+                    result = await func(*args, **kwargs)
+                    computed = True
+            except Exception as e:
+                fut.set_exception(e)
+                fut.exception()  # помечаем как обработанное, чтобы не было warning без ожидающих
+                raise
+            else:
+                fut.set_result(result)
+            finally:
+                _inflight.pop(cache_key, None)
+
+            # Кэшируем уже сериализованный JSON: на хите не нужен ни Pydantic-дамп,
+            # ни повторная кодировка. Запись уходит в фон под тегом key_prefix
+            if computed and cache.is_connected() and result is not None:
+                body = orjson.dumps(result, default=_msgpack_default)
+                _schedule_cache_write(
+                    _store_and_unlock(cache, cache_key, body, ttl, key_prefix, got_lock)
+                )
+
+            # Дождались байтов от чужого пересчета — Response строим под свой запрос
+            if isinstance(result, (bytes, bytearray)):
+                return _cached_response(bytes(result), ttl, request)
             return result
         return wrapper
     return decorator
 
 # Декоратор для инвалидации кэша
-def invalidate_cache(pattern: str = "*"):
-    """Декоратор для инвалидации кэша после операции"""
+def invalidate_cache(tag: str = "cache", key_func=None):
+    """Декоратор для инвалидации кэша после операции (по Set-индексу тега, не по паттерну).
+
+    key_func(result, **kwargs) может вернуть дополнительные точечные ключи
+    (например, кэш конкретной задачи) — они удаляются тем же pipeline.
+    """
     def decorator(func):
         @wraps(func)
         async def wrapper(*args, **kwargs):
             # Выполняем функцию
             result = await func(*args, **kwargs)
-            
-            # Инвалидируем кэш
+
+            # Инвалидируем кэш одним pipeline в фоне — ответ не ждет housekeeping
             cache = redis_cache
             if cache.is_connected():
-                deleted = await cache.delete_pattern(pattern)
-                print(f"Cache invalidated: {deleted} keys with pattern '{pattern}'")
-                
+                extra_keys = key_func(result, **kwargs) if key_func else ()
+                _schedule_cache_write(cache.invalidate_tag(tag, extra_keys))
+
             return result
         return wrapper
     return decorator
@@ -1,22 +1,42 @@
-from fastapi import FastAPI, Request, Response
+from fastapi import FastAPI, Response
+from fastapi.responses import ORJSONResponse
 from routes import router
 from cache import redis_cache
 from db import db
-from metrics import get_metrics, track_endpoint_metrics, increment_endpoint_counter, record_endpoint_duration
+from metrics import (
+    get_metrics,
+    track_endpoint_metrics,
+    increment_endpoint_counter,
+    metrics_flush_loop,
+    flush_local_metrics,
+)
 import uvicorn
+import uvloop
+import asyncio
+import orjson
 from contextlib import asynccontextmanager
+from datetime import datetime, timezone
 import time
 from prometheus_client import CONTENT_TYPE_LATEST
 
+# Ставим uvloop политикой по умолчанию: работает и при запуске
+# через `uvicorn main:app` без флага --loop
+uvloop.install()
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await db.connect()
     await redis_cache.connect()
+    # Периодический сброс локальных аккумуляторов метрик в Prometheus
+    flusher = asyncio.create_task(metrics_flush_loop())
     print("Application started")
-    
+
     yield
-    
+
+    flusher.cancel()
+    # Финальный сброс, чтобы не потерять накопленное между тиками
+    flush_local_metrics()
     await redis_cache.disconnect()
     await db.disconnect()
     print("Application stopped")
@@ -25,87 +45,98 @@ app = FastAPI(
     title="Tasks API with Metrics",
     description="REST API для задач с метриками Prometheus",
     version="2.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    # orjson сериализует ответы (включая datetime) в разы быстрее stdlib json
+    default_response_class=ORJSONResponse
 )
 
-@app.middleware("http")
-async def metrics_middleware(request: Request, call_next):
-    start_time = time.time()
-    
-    try:
-        response = await call_next(request)
-        
-        path = request.url.path
-        method = request.method
-        
-        if path == "/":
-            increment_endpoint_counter('root')
-        elif path == "/health":
-            increment_endpoint_counter('health_check')
-            record_endpoint_duration('health_check', time.time() - start_time)
-        elif path == "/metrics":
-            pass  
-        
-        return response
-        
-    except Exception as e:
-        raise
-    finally:
-        pass
-
 app.include_router(router, prefix="/api/v1")
 
+# Ответ корневого эндпоинта статичен — сериализуем его один раз при старте
+_ROOT_BODY = orjson.dumps({
+    "message": "Tasks API with Metrics is running",
+    "docs": "/docs",
+    "redoc": "/redoc",
+    "health": "/health",
+    "metrics": "/metrics",
+    "cache_stats": "/api/v1/tasks/cache/stats"
+})
+
 @app.get("/")
 @track_endpoint_metrics("root", "GET")
 async def root():
-    return {
-        "message": "Tasks API with Metrics is running",
-        "docs": "/docs",
-        "redoc": "/redoc",
-        "health": "/health",
-        "metrics": "/metrics",
-        "cache_stats": "/api/v1/tasks/cache/stats"
-    }
+    increment_endpoint_counter('root')
+    return Response(content=_ROOT_BODY, media_type="application/json")
 
 @app.get("/health")
 @track_endpoint_metrics("health_check", "GET")
 async def health_check():
+    increment_endpoint_counter('health_check')
     health_status = {
         "status": "healthy",
         "database": "disconnected",
         "cache": "disabled",
-        "timestamp": __import__("datetime").datetime.utcnow().isoformat()
+        "timestamp": datetime.now(timezone.utc).isoformat()
     }
-    
-    try:
-        if db.pool:
-            async with db.pool.acquire() as conn:
-                await conn.execute("SELECT 1")
-            health_status["database"] = "connected"
-    except Exception as e:
-        health_status["database"] = f"error: {str(e)}"
+
+    async def _db_ping():
+        if not db.pool:
+            return "disconnected"
+        async with db.pool.acquire() as conn:
+            # SELECT 1 подготовлен при создании соединения — идет через кэш выражений
+            await conn.fetchval("SELECT 1")
+        return "connected"
+
+    async def _cache_ping():
+        if not redis_cache.enabled:
+            return "disabled"
+        if not redis_cache.is_connected():
+            return "disconnected"
+        await redis_cache.client.ping()
+        return "connected"
+
+    # Проверки независимы — выполняем их параллельно, латентность = max(db, redis)
+    db_res, cache_res = await asyncio.gather(
+        _db_ping(), _cache_ping(), return_exceptions=True
+    )
+
+    if isinstance(db_res, Exception):
+        health_status["database"] = f"error: {str(db_res)}"
         health_status["status"] = "unhealthy"
-    
-    if redis_cache.enabled:
-        if redis_cache.is_connected():
-            try:
-                await redis_cache.client.ping()
-                health_status["cache"] = "connected"
-            except Exception as e:
-                health_status["cache"] = f"error: {str(e)}"
-                health_status["status"] = "unhealthy"
-        else:
-            health_status["cache"] = "disconnected"
+    else:
+        health_status["database"] = db_res
+
+    if isinstance(cache_res, Exception):
+        health_status["cache"] = f"error: {str(cache_res)}"
+        health_status["status"] = "unhealthy"
+    else:
+        health_status["cache"] = cache_res
+        if cache_res == "disconnected":
             health_status["status"] = "degraded"
-    
+
     return health_status
 
+# Кэш сериализованных метрик: generate_latest обходит все коллекторы,
+# при частом опросе (Prometheus + Grafana Agent и т.п.) отдаем снимок не старше 1 секунды
+_metrics_cache = {"t": 0.0, "buf": b""}
+
 @app.get("/metrics")
 async def metrics():
+    now = time.monotonic()
+    if now - _metrics_cache["t"] > 1.0:
+        _metrics_cache["buf"] = get_metrics()
+        _metrics_cache["t"] = now
     return Response(
-        content=get_metrics(),
+        content=_metrics_cache["buf"],
         media_type=CONTENT_TYPE_LATEST
     )
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        reload=True,
+        loop="uvloop",
+        http="httptools"
+    )
\ No newline at end of file
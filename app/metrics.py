@@ -1,5 +1,6 @@
 from prometheus_client import Counter, Histogram, Gauge, generate_latest, REGISTRY
 from prometheus_client.multiprocess import MultiProcessCollector
+import asyncio
 import time
 from functools import wraps
 import os
@@ -29,7 +30,6 @@ tasks_get_all_duration = Histogram(
 tasks_get_by_id_total = Counter(
     'tasks_get_by_id_total',
     'Total GET requests to get task by ID',
-    ['task_id'],
     registry=registry
 )
 
@@ -55,7 +55,6 @@ tasks_create_duration = Histogram(
 tasks_update_total = Counter(
     'tasks_update_total',
     'Total PUT requests to update task',
-    ['task_id'],
     registry=registry
 )
 
@@ -69,7 +68,6 @@ tasks_update_duration = Histogram(
 tasks_delete_total = Counter(
     'tasks_delete_total',
     'Total DELETE requests to delete task',
-    ['task_id'],
     registry=registry
 )
 
@@ -87,6 +85,12 @@ tasks_get_by_status_total = Counter(
     registry=registry
 )
 
+tasks_export_total = Counter(
+    'tasks_export_total',
+    'Total GET requests to export all tasks',
+    registry=registry
+)
+
 tasks_search_total = Counter(
     'tasks_search_total',
     'Total GET requests to search tasks',
@@ -151,97 +155,141 @@ requests_in_progress = Gauge(
     registry=registry
 )
 
-def track_endpoint_metrics(endpoint_name: str, method: str = "GET"):
+def track_endpoint_metrics(endpoint_name: str, method: str = "GET", duration_name: str = None):
+    # duration_name — ключ эндпоинт-специфичной гистограммы из _HISTOGRAMS;
+    # декоратор уже меряет время, так что обработчикам свой time.time() не нужен
     def decorator(func: Callable):
+        # endpoint_name и method известны на этапе декорирования —
+        # резолвим дочерние метрики один раз, а не через .labels() на каждый запрос
+        _in_progress = requests_in_progress.labels(endpoint=endpoint_name)
+        _response_time = endpoint_response_time.labels(
+            endpoint=endpoint_name, method=method
+        )
+        _responses = {
+            200: tasks_responses_total.labels(
+                endpoint=endpoint_name, method=method, status_code=200
+            )
+        }
+
+        def _response_counter(status_code: int):
+            child = _responses.get(status_code)
+            if child is None:
+                child = tasks_responses_total.labels(
+                    endpoint=endpoint_name, method=method, status_code=status_code
+                )
+                _responses[status_code] = child
+            return child
+
         @wraps(func)
         async def wrapper(*args, **kwargs):
-            requests_in_progress.labels(endpoint=endpoint_name).inc()
-            
-            start_time = time.time()
-            
+            _in_progress.inc()
+
+            start_time = time.perf_counter()
+
             try:
                 response = await func(*args, **kwargs)
-                
-                duration = time.time() - start_time
-                
-                endpoint_response_time.labels(
-                    endpoint=endpoint_name,
-                    method=method
-                ).observe(duration)
-                tasks_responses_total.labels(
-                    endpoint=endpoint_name,
-                    method=method,
-                    status_code=200
-                ).inc()
-                
+
+                duration = time.perf_counter() - start_time
+
+                _response_time.observe(duration)
+                _responses[200].inc()
+                if duration_name:
+                    record_endpoint_duration(duration_name, duration)
+
                 return response
-                
+
             except Exception as e:
-                duration = time.time() - start_time
-                
-                endpoint_response_time.labels(
-                    endpoint=endpoint_name,
-                    method=method
-                ).observe(duration)
-                
+                duration = time.perf_counter() - start_time
+
+                _response_time.observe(duration)
+
                 status_code = 500
                 if hasattr(e, 'status_code'):
                     status_code = e.status_code
-                
-                tasks_responses_total.labels(
-                    endpoint=endpoint_name,
-                    method=method,
-                    status_code=status_code
-                ).inc()
-                
+
+                _response_counter(status_code).inc()
+
                 tasks_errors_total.labels(
                     endpoint=endpoint_name,
                     error_type=type(e).__name__
                 ).inc()
-                
+
                 raise
-                
+
             finally:
-                requests_in_progress.labels(endpoint=endpoint_name).dec()
-                
+                _in_progress.dec()
+
         return wrapper
     return decorator
 
 
+# Диспетчерские таблицы собраны один раз на уровне модуля,
+# чтобы не строить словарь заново на каждый инкремент
+_COUNTERS = {
+    'tasks_get_all': tasks_get_all_total,
+    'tasks_get_by_id': tasks_get_by_id_total,
+    'tasks_create': tasks_create_total,
+    'tasks_update': tasks_update_total,
+    'tasks_delete': tasks_delete_total,
+    'tasks_get_by_status': tasks_get_by_status_total,
+    'tasks_export': tasks_export_total,
+    'tasks_search': tasks_search_total,
+    'cache_stats_get': cache_stats_get_total,
+    'cache_clear_post': cache_clear_post_total,
+    'health_check': health_check_total,
+    'root': root_total,
+}
+
+_HISTOGRAMS = {
+    'tasks_get_all': tasks_get_all_duration,
+    'tasks_get_by_id': tasks_get_by_id_duration,
+    'tasks_create': tasks_create_duration,
+    'tasks_update': tasks_update_duration,
+    'tasks_delete': tasks_delete_duration,
+    'health_check': health_check_duration,
+}
+
+# Локальные аккумуляторы воркера: на горячем пути запрос стоит один
+# инкремент/append в обычный dict, без мьютексов prometheus_client.
+# Раз в секунду фоновая задача переливает накопленное в реальные метрики.
+_local_counters: dict = {}
+_local_durations: dict = {}
+
+FLUSH_INTERVAL = 1.0
+
 def increment_endpoint_counter(counter_name: str, labels: dict = None):
-    counters = {
-        'tasks_get_all': tasks_get_all_total,
-        'tasks_get_by_id': tasks_get_by_id_total,
-        'tasks_create': tasks_create_total,
-        'tasks_update': tasks_update_total,
-        'tasks_delete': tasks_delete_total,
-        'tasks_get_by_status': tasks_get_by_status_total,
-        'tasks_search': tasks_search_total,
-        'cache_stats_get': cache_stats_get_total,
-        'cache_clear_post': cache_clear_post_total,
-        'health_check': health_check_total,
-        'root': root_total,
-    }
-    
-    if counter_name in counters:
-        counter = counters[counter_name]
-        if labels:
-            counter.labels(**labels).inc()
-        else:
-            counter.inc()
+    key = (counter_name, tuple(sorted(labels.items()))) if labels else counter_name
+    _local_counters[key] = _local_counters.get(key, 0) + 1
 
 def record_endpoint_duration(counter_name: str, duration: float):
-    histograms = {
-        'tasks_get_all': tasks_get_all_duration,
-        'tasks_get_by_id': tasks_get_by_id_duration,
-        'tasks_create': tasks_create_duration,
-        'tasks_update': tasks_update_duration,
-        'tasks_delete': tasks_delete_duration,
-        'health_check': health_check_duration,
-    }
-    
-    if counter_name in histograms:
-        histograms[counter_name].observe(duration)
+    _local_durations.setdefault(counter_name, []).append(duration)
+
+def flush_local_metrics():
+    """Переливает локальные аккумуляторы в метрики Prometheus.
+    Вызывается фоновой задачей и один раз при остановке приложения."""
+    while _local_counters:
+        key, count = _local_counters.popitem()
+        name, label_items = key if isinstance(key, tuple) else (key, None)
+        counter = _COUNTERS.get(name)
+        if counter is None:
+            continue
+        if label_items:
+            counter.labels(**dict(label_items)).inc(count)
+        else:
+            counter.inc(count)
+
+    while _local_durations:
+        name, durations = _local_durations.popitem()
+        histogram = _HISTOGRAMS.get(name)
+        if histogram is not None:
+            for duration in durations:
+                histogram.observe(duration)
+
+async def metrics_flush_loop():
+    """Фоновая задача (стартует в lifespan): сбрасывает аккумуляторы раз в FLUSH_INTERVAL"""
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        flush_local_metrics()
 
 
 def get_metrics():
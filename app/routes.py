@@ -1,19 +1,29 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
 from datetime import datetime
 from db import db
-from cache import redis_cache, cache_response, invalidate_cache
-from metrics import track_endpoint_metrics, increment_endpoint_counter, record_endpoint_duration
+from cache import redis_cache, cache_response, invalidate_cache, task_cache_key
+from metrics import track_endpoint_metrics, increment_endpoint_counter
+import asyncio
 import asyncpg
-import time
+import msgspec
+import orjson
 
 router = APIRouter(prefix="/tasks", tags=["Tasks"])
 
-class TaskCreate(BaseModel):
+# Входные модели — msgspec.Struct: декодируются напрямую из JSON-байтов,
+# без промежуточного dict и Python-цикла валидации Pydantic
+class TaskCreate(msgspec.Struct):
     title: str
     description: Optional[str] = None
-    status: Optional[str] = "active"
+    status: str = "active"
+
+class TaskUpdate(msgspec.Struct):
+    title: Optional[str] = None
+    description: Optional[str] = None
+    status: Optional[str] = None
 
 class TaskResponse(BaseModel):
     id: int
@@ -21,14 +31,24 @@ class TaskResponse(BaseModel):
     description: Optional[str] = None
     status: str
     created_at: datetime
-    
+
     class Config:
         from_attributes = True
 
-class TaskUpdate(BaseModel):
-    title: Optional[str] = None
-    description: Optional[str] = None
-    status: Optional[str] = None
+def msgspec_body(model):
+    """Зависимость: декодирует тело запроса в msgspec.Struct.
+    Ошибки типов отдаем как 422 в духе FastAPI, битый JSON — как 400."""
+    decoder = msgspec.json.Decoder(model)
+
+    async def _decode(request: Request):
+        try:
+            return decoder.decode(await request.body())
+        except msgspec.ValidationError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        except msgspec.DecodeError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid JSON: {e}")
+
+    return _decode
 
 async def get_connection():
     if not db.pool:
@@ -39,100 +59,145 @@ async def get_connection():
 @router.get("/cache/stats")
 @track_endpoint_metrics("cache_stats", "GET")
 async def get_cache_stats():
-    start_time = time.time()
     increment_endpoint_counter('cache_stats_get')
-    
-    stats = await redis_cache.get_stats()
-    
-    duration = time.time() - start_time
-    return stats
+    return await redis_cache.get_stats()
 
 @router.post("/cache/clear")
 @track_endpoint_metrics("cache_clear", "POST")
 async def clear_cache():
-    start_time = time.time()
     increment_endpoint_counter('cache_clear_post')
-    
+
     if not redis_cache.enabled:
         raise HTTPException(status_code=400, detail="Cache is disabled")
-    
+
     success = await redis_cache.clear_all()
-    
-    duration = time.time() - start_time
+
     if success:
         return {"message": "Cache cleared successfully"}
     raise HTTPException(status_code=500, detail="Failed to clear cache")
 
 @router.get("/", response_model=List[TaskResponse])
 @cache_response(ttl=60, key_prefix="tasks")
-@track_endpoint_metrics("get_all_tasks", "GET")
-async def get_all_tasks():
-    start_time = time.time()
+@track_endpoint_metrics("get_all_tasks", "GET", duration_name='tasks_get_all')
+async def get_all_tasks(
+    request: Request,
+    limit: int = 100,
+    before: Optional[datetime] = None,
+    before_id: Optional[int] = None
+):
     increment_endpoint_counter('tasks_get_all')
-    
+
+    # Ограничиваем объем работы на запрос независимо от размера таблицы
+    limit = max(1, min(limit, 1000))
+
     try:
         pool = await get_connection()
         async with pool.acquire() as conn:
-            results = await conn.fetch(
-                "SELECT id, title, description, status, created_at FROM tasks ORDER BY created_at DESC, id"
-            )
-            
-            tasks = []
-            for row in results:
-                task_dict = {
-                    "id": row["id"],
-                    "title": row["title"],
-                    "description": row["description"],
-                    "status": row["status"],
-                    "created_at": row["created_at"]
-                }
-                tasks.append(TaskResponse(**task_dict))
-            
-            duration = time.time() - start_time
-            record_endpoint_duration('tasks_get_all', duration)
+            results = await conn.stmts["get_all"].fetch(before, before_id or 0, limit)
+
+            # model_construct пропускает валидацию — данные приходят из доверенной схемы БД
+            tasks = [
+                TaskResponse.model_construct(
+                    id=row[0],
+                    title=row[1],
+                    description=row[2],
+                    status=row[3],
+                    created_at=row[4]
+                )
+                for row in results
+            ]
+
             return tasks
             
     except asyncpg.exceptions.PostgresError as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
+# Курсор отдает строки порциями — память не зависит от размера таблицы
+EXPORT_SQL = """
+    SELECT id, title, description, status, created_at
+    FROM tasks
+    ORDER BY created_at DESC, id DESC
+"""
+
+@router.get("/export/")
+@track_endpoint_metrics("export_tasks", "GET")
+async def export_tasks():
+    increment_endpoint_counter('tasks_export')
+
+    pool = await get_connection()
+
+    async def stream():
+        # Стримим JSON-массив по мере чтения курсора: первый байт уходит
+        # с первой строкой, полный результат в Python не материализуется
+        yield b"["
+        first = True
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                async for row in conn.cursor(EXPORT_SQL, prefetch=500):
+                    chunk = orjson.dumps({
+                        "id": row[0],
+                        "title": row[1],
+                        "description": row[2],
+                        "status": row[3],
+                        "created_at": row[4]
+                    })
+                    if first:
+                        first = False
+                    else:
+                        yield b","
+                    yield chunk
+        yield b"]"
+
+    return StreamingResponse(stream(), media_type="application/json")
+
+TASK_CACHE_TTL = 120
+
 @router.get("/{task_id}", response_model=TaskResponse)
-@cache_response(ttl=120, key_prefix="task")
-@track_endpoint_metrics("get_task_by_id", "GET")
+@track_endpoint_metrics("get_task_by_id", "GET", duration_name='tasks_get_by_id')
 async def get_task_by_id(task_id: int):
-    start_time = time.time()
-    increment_endpoint_counter('tasks_get_by_id', {'task_id': str(task_id)})
-    
-    try:
+    increment_endpoint_counter('tasks_get_by_id')
+
+    async def _fetch_from_db():
         pool = await get_connection()
         async with pool.acquire() as conn:
-            result = await conn.fetchrow(
-                "SELECT id, title, description, status, created_at FROM tasks WHERE id = $1",
-                task_id
-            )
-            
-            if not result:
-                raise HTTPException(status_code=404, detail=f"Task with id {task_id} not found")
-            
-            task_dict = {
-                "id": result["id"],
-                "title": result["title"],
-                "description": result["description"],
-                "status": result["status"],
-                "created_at": result["created_at"]
-            }
-            
-            duration = time.time() - start_time
-            record_endpoint_duration('tasks_get_by_id', duration)
-            return TaskResponse(**task_dict)
-            
+            return await conn.stmts["get_by_id"].fetchrow(task_id)
+
+    cache_key = task_cache_key(task_id)
+
+    # Спекулятивно стартуем запрос к БД параллельно с Redis GET:
+    # при промахе латентность = max(redis, db), а не redis + db
+    db_task = asyncio.create_task(_fetch_from_db())
+
+    cached = await redis_cache.get(cache_key)
+    if cached is not None:
+        db_task.cancel()
+        return cached
+
+    try:
+        result = await db_task
     except asyncpg.exceptions.PostgresError as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
+    if not result:
+        raise HTTPException(status_code=404, detail=f"Task with id {task_id} not found")
+
+    # Доступ по индексу: колонки зафиксированы SELECT'ом, без hash-lookup по имени
+    task_dict = {
+        "id": result[0],
+        "title": result[1],
+        "description": result[2],
+        "status": result[3],
+        "created_at": result[4]
+    }
+
+    redis_cache.set_background(cache_key, task_dict, TASK_CACHE_TTL)
+
+    return TaskResponse.model_construct(**task_dict)
+
 @router.post("/", response_model=TaskResponse, status_code=201)
-@invalidate_cache(pattern="tasks:*")
-@track_endpoint_metrics("create_task", "POST")
-async def create_task(task: TaskCreate):
-    start_time = time.time()
+@invalidate_cache(tag="tasks", key_func=lambda result, **_: (task_cache_key(result.id),))
+@track_endpoint_metrics("create_task", "POST", duration_name='tasks_create')
+async def create_task(task: TaskCreate = Depends(msgspec_body(TaskCreate))):
     increment_endpoint_counter('tasks_create')
     
     try:
@@ -150,20 +215,15 @@ async def create_task(task: TaskCreate):
             if not result:
                 raise HTTPException(status_code=500, detail="Failed to create task")
             
-            task_dict = {
-                "id": result["id"],
-                "title": result["title"],
-                "description": result["description"],
-                "status": result["status"],
-                "created_at": result["created_at"]
-            }
-            
-            if redis_cache.is_connected():
-                await redis_cache.delete(f"task:get_task_by_id:{hash(str((task_dict['id'],)))}")
-            
-            duration = time.time() - start_time
-            record_endpoint_duration('tasks_create', duration)
-            return TaskResponse(**task_dict)
+            saved = TaskResponse.model_construct(
+                id=result[0],
+                title=result[1],
+                description=result[2],
+                status=result[3],
+                created_at=result[4]
+            )
+
+            return saved
             
     except asyncpg.exceptions.UniqueViolationError:
         raise HTTPException(status_code=409, detail="Task already exists")
@@ -171,90 +231,57 @@ async def create_task(task: TaskCreate):
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
 @router.put("/{task_id}", response_model=TaskResponse)
-@invalidate_cache(pattern="tasks:*")
-@track_endpoint_metrics("update_task", "PUT")
-async def update_task(task_id: int, task: TaskUpdate):
-    start_time = time.time()
-    increment_endpoint_counter('tasks_update', {'task_id': str(task_id)})
+@invalidate_cache(tag="tasks", key_func=lambda result, task_id, **_: (task_cache_key(task_id),))
+@track_endpoint_metrics("update_task", "PUT", duration_name='tasks_update')
+async def update_task(task_id: int, task: TaskUpdate = Depends(msgspec_body(TaskUpdate))):
+    increment_endpoint_counter('tasks_update')
     
     try:
+        if task.title is None and task.description is None and task.status is None:
+            raise HTTPException(status_code=400, detail="No fields to update")
+
         pool = await get_connection()
         async with pool.acquire() as conn:
-            current = await conn.fetchrow(
-                "SELECT id, title, description, status FROM tasks WHERE id = $1",
-                task_id
+            # Один статический запрос: COALESCE оставляет не переданные поля как есть
+            result = await conn.stmts["update"].fetchrow(
+                task_id, task.title, task.description, task.status
             )
-            
-            if not current:
+
+            # Несуществующий id определяем по пустому RETURNING — без отдельного SELECT
+            if not result:
                 raise HTTPException(status_code=404, detail=f"Task with id {task_id} not found")
-            
-            update_fields = {}
-            if task.title is not None:
-                update_fields['title'] = task.title
-            if task.description is not None:
-                update_fields['description'] = task.description
-            if task.status is not None:
-                update_fields['status'] = task.status
-                
-            if not update_fields:
-                raise HTTPException(status_code=400, detail="No fields to update")
-            
-            set_clause = ", ".join([f"{field} = ${i+2}" for i, field in enumerate(update_fields.keys())])
-            values = list(update_fields.values())
-            
-            result = await conn.fetchrow(
-                f"""
-                UPDATE tasks 
-                SET {set_clause}, updated_at = CURRENT_TIMESTAMP
-                WHERE id = $1
-                RETURNING id, title, description, status, created_at
-                """,
-                task_id, *values
+
+            saved = TaskResponse.model_construct(
+                id=result[0],
+                title=result[1],
+                description=result[2],
+                status=result[3],
+                created_at=result[4]
             )
-            
-            task_dict = {
-                "id": result["id"],
-                "title": result["title"],
-                "description": result["description"],
-                "status": result["status"],
-                "created_at": result["created_at"]
-            }
-            
-            if redis_cache.is_connected():
-                await redis_cache.delete(f"task:get_task_by_id:{hash(str((task_id,)))}")
-            
-            duration = time.time() - start_time
-            record_endpoint_duration('tasks_update', duration)
-            return TaskResponse(**task_dict)
+
+            return saved
             
     except asyncpg.exceptions.PostgresError as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
 @router.delete("/{task_id}")
-@invalidate_cache(pattern="tasks:*")
-@track_endpoint_metrics("delete_task", "DELETE")
+@invalidate_cache(tag="tasks", key_func=lambda result, task_id, **_: (task_cache_key(task_id),))
+@track_endpoint_metrics("delete_task", "DELETE", duration_name='tasks_delete')
 async def delete_task(task_id: int):
-    start_time = time.time()
-    increment_endpoint_counter('tasks_delete', {'task_id': str(task_id)})
+    increment_endpoint_counter('tasks_delete')
     
     try:
         pool = await get_connection()
         async with pool.acquire() as conn:
-            exists = await conn.fetchval(
-                "SELECT EXISTS(SELECT 1 FROM tasks WHERE id = $1)",
+            # Один запрос вместо EXISTS + DELETE: 404 определяем по пустому RETURNING
+            deleted = await conn.fetchval(
+                "DELETE FROM tasks WHERE id = $1 RETURNING id",
                 task_id
             )
-            
-            if not exists:
+
+            if deleted is None:
                 raise HTTPException(status_code=404, detail=f"Task with id {task_id} not found")
-            
-            await conn.execute("DELETE FROM tasks WHERE id = $1", task_id)
-            
-            if redis_cache.is_connected():
-                await redis_cache.delete(f"task:get_task_by_id:{hash(str((task_id,)))}")
-            
-            duration = time.time() - start_time
-            record_endpoint_duration('tasks_delete', duration)
+
             return {"message": f"Task {task_id} deleted successfully"}
             
     except asyncpg.exceptions.PostgresError as e:
@@ -263,34 +290,24 @@ async def delete_task(task_id: int):
 @router.get("/status/{status}", response_model=List[TaskResponse])
 @cache_response(ttl=90, key_prefix="tasks_by_status")
 @track_endpoint_metrics("get_tasks_by_status", "GET")
-async def get_tasks_by_status(status: str):
+async def get_tasks_by_status(request: Request, status: str):
     increment_endpoint_counter('tasks_get_by_status', {'status': status})
     
     try:
         pool = await get_connection()
         async with pool.acquire() as conn:
-            results = await conn.fetch(
-                """
-                SELECT id, title, description, status, created_at 
-                FROM tasks 
-                WHERE status = $1 
-                ORDER BY created_at DESC
-                """,
-                status
-            )
-            
-            tasks = []
-            for row in results:
-                task_dict = {
-                    "id": row["id"],
-                    "title": row["title"],
-                    "description": row["description"],
-                    "status": row["status"],
-                    "created_at": row["created_at"]
-                }
-                tasks.append(TaskResponse(**task_dict))
-            
-            return tasks
+            results = await conn.stmts["get_by_status"].fetch(status)
+
+            return [
+                TaskResponse.model_construct(
+                    id=row[0],
+                    title=row[1],
+                    description=row[2],
+                    status=row[3],
+                    created_at=row[4]
+                )
+                for row in results
+            ]
             
     except asyncpg.exceptions.PostgresError as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
@@ -298,36 +315,25 @@ async def get_tasks_by_status(status: str):
 @router.get("/search/", response_model=List[TaskResponse])
 @cache_response(ttl=120, key_prefix="tasks_search")
 @track_endpoint_metrics("search_tasks", "GET")
-async def search_tasks(q: str, limit: int = 10):
+async def search_tasks(request: Request, q: str, limit: int = 10):
     increment_endpoint_counter('tasks_search')
     
     try:
         pool = await get_connection()
         async with pool.acquire() as conn:
             search_term = f"%{q}%"
-            results = await conn.fetch(
-                """
-                SELECT id, title, description, status, created_at 
-                FROM tasks 
-                WHERE title ILIKE $1 OR description ILIKE $1
-                ORDER BY created_at DESC
-                LIMIT $2
-                """,
-                search_term, limit
-            )
-            
-            tasks = []
-            for row in results:
-                task_dict = {
-                    "id": row["id"],
-                    "title": row["title"],
-                    "description": row["description"],
-                    "status": row["status"],
-                    "created_at": row["created_at"]
-                }
-                tasks.append(TaskResponse(**task_dict))
-            
-            return tasks
+            results = await conn.stmts["search"].fetch(search_term, limit)
+
+            return [
+                TaskResponse.model_construct(
+                    id=row[0],
+                    title=row[1],
+                    description=row[2],
+                    status=row[3],
+                    created_at=row[4]
+                )
+                for row in results
+            ]
             
     except asyncpg.exceptions.PostgresError as e:
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
\ No newline at end of file
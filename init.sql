@@ -4,4 +4,12 @@ CREATE TABLE IF NOT EXISTS tasks (
                     description TEXT,
                     status VARCHAR(50) DEFAULT 'active',
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
\ No newline at end of file
+                );
+
+-- Составной индекс под keyset-пагинацию списка задач
+CREATE INDEX IF NOT EXISTS tasks_created_at_id_idx ON tasks (created_at DESC, id DESC);
+
+-- Триграммные GIN-индексы: поиск ILIKE '%q%' идет по индексу вместо seq scan
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS tasks_title_trgm ON tasks USING GIN (title gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS tasks_desc_trgm ON tasks USING GIN (description gin_trgm_ops);
\ No newline at end of file